@@ -5,14 +5,15 @@ import os
 import csv
 import json
 import re
-import pydicom
-import matplotlib.pyplot as plt
 from io import BytesIO
 import base64
 
 
 handlers_bp = Blueprint('handlers_bp', __name__)
 
+# Runs of path delimiters, collapsed to one in file_viewer
+MULTIPLE_SLASHES = re.compile(r'/+')
+
 
 # But using the "path:" keyword, all the path information after will get assigned to one variable
 @handlers_bp.route('/viewer/subjects/<subject_name>/studies/<study_name>/files/<path:file_relative_path>', methods=['GET', 'PUT'])
@@ -38,7 +39,7 @@ def file_viewer(file_relative_path, subject_name=None, study_name=None, process_
         readonly = False
 
     # HACK - the javascript sometimes adds an extra path delimiter. 
-    file_path = re.sub(r'/+', '/', file_path)
+    file_path = MULTIPLE_SLASHES.sub('/', file_path)
     current_app.logger.info(f'file_viewer: file_path = {file_path}')
 
     # Get File type
@@ -112,6 +113,10 @@ def file_viewer(file_relative_path, subject_name=None, study_name=None, process_
             current_app.logger.warning('file_viewer: Invalid file path:', file_path)
             abort(404)
 
+        # These are slow to import, so only load them when a DICOM is viewed
+        import pydicom
+        import matplotlib.pyplot as plt
+
         # Read the DICOM file
         dicom_data = pydicom.dcmread(file_path)
 
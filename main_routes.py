@@ -23,6 +23,9 @@ import csv
 # Create a Blueprint
 main_bp = Blueprint('main_bp', __name__)
 
+# DICOM header fields shown on the study page. Only these are read from the sample file.
+STUDY_DICOM_TAGS = ['StudyDate', 'StudyTime', 'PatientSex', 'PatientWeight', 'PatientSize', 'PatientAge', 'PatientName']
+
 
 # Home route
 @main_bp.route('/')
@@ -107,19 +110,22 @@ def study(subject_name, study_name):
                 if len(row) >= 2:
                     dicom_tags[int(row[0])] = row[1]
 
-    dicom_info = get_sample_dicom_header(subject_name, study_name)
+    dicom_info = get_sample_dicom_header(subject_name, study_name, specific_tags=STUDY_DICOM_TAGS)
     if os.path.isdir(dicom_path):
-        for folder_name in sorted(os.listdir(dicom_path)):
-            folder_path = os.path.join(dicom_path, folder_name)
-            if os.path.isdir(folder_path):
-                series_number = get_series_number_from_folder(folder_name)
-                if series_number is not None:
-                    tag = dicom_tags.get(series_number, "")
-                    dicom_folders.append({
-                        'name': folder_name,
-                        'relative_path': os.path.join('dicom-original', folder_name),
-                        'series_number': series_number,
-                        'tag': tag
-                    })
+        with os.scandir(dicom_path) as entries:
+            series_dirs = [e.name for e in entries if e.is_dir()]
+        for folder_name in series_dirs:
+            series_number = get_series_number_from_folder(folder_name)
+            if series_number is not None:
+                tag = dicom_tags.get(series_number, "")
+                dicom_folders.append({
+                    'name': folder_name,
+                    'relative_path': os.path.join('dicom-original', folder_name),
+                    'series_number': series_number,
+                    'tag': tag
+                })
+        # Sort by series number, not by name. Series numbers have 3-5 digits, so the
+        # names don't sort numerically (MR-SE1001 would come before MR-SE999)
+        dicom_folders.sort(key=lambda f: (f['series_number'], f['name']))
 
     return render_template('study.html', subject=subject_name, study=study_name, notes=notes, tool_menu=tool_menu, file_tree=file_tree, dicom_folders=dicom_folders, dicom_info=dicom_info)
\ No newline at end of file
@@ -2,18 +2,44 @@
 Starting by writing this specifically for modules that operate on studies, not those
 that work on subjects, projects, etc. Will get this working first then generalize.
 
-Note that calling status for each  module is time consuming. I have print() calls
+Note that calling status for each  module is time consuming. I have timing log calls
 in place. Could optimize somehow, perhaps using "watchdog" to keep track of when 
-studies are modified.
+studies are modified. For now status results are cached for a couple of seconds, 
+as long as the target folder's modification time hasn't changed.
 
 """
-from tools.process_module_manager import ProcessModuleManager
 from utils import get_study_path, get_module_folder, get_data_folder, get_subject_path
 import os
 import subprocess
 import json     
 from flask import current_app
 import time
+import threading
+
+# Parsed output of each script's 'properties' command, shared by all wrappers.
+# {script_path: (mtime_ns, properties)}. If the script is edited, it's called again.
+_properties_cache = {}
+
+# Results of the 'status' command. {(script_path, target_path): (mtime_ns, time, status)}
+# An entry is used only if the target's mtime is unchanged and it's recent. Only the 
+# top-level folder mtime is checked, so keep the age short.
+_status_cache = {}
+# Statuses are checked from several threads at once (tool menus, bulk jobs), so changes 
+# to the cache are made under this lock
+_status_cache_lock = threading.Lock()
+STATUS_CACHE_SECONDS = 2.0
+
+def clear_status_cache(target_path=None):
+    """
+    Forget cached status results for a target path, or for all targets if None.
+    Call this after running a command that changes the target.
+    """
+    with _status_cache_lock:
+        if target_path is None:
+            _status_cache.clear()
+        else:
+            for key in [k for k in _status_cache if k[1] == target_path]:
+                del _status_cache[key]
 
 class ModuleWrapper():
     def __init__(self, module_name=None, module_folder=None, module_script=None):
@@ -25,22 +51,31 @@ class ModuleWrapper():
         if not os.path.isfile(self.script_path):    
             raise FileNotFoundError(f'Module script not found: {self.script_path}')     
         
-        # Call the script and parse its output
-        # Here, called once during initialization
-        self.properties = self.get_script_properties() 
+        # Call the script and parse its output. Done once here so a broken module 
+        # fails early; after that it's only re-run if the script changes
+        self.get_script_properties() 
+
+    @property
+    def properties(self):
+        return self.get_script_properties()
 
     def get_script_properties(self):
         """
         Runs the script at script_path with the command 'properties',
         captures its output, and parses it into a JSON object.
+        The result is cached until the script's modification time changes.
         """
+        mtime = os.stat(self.script_path).st_mtime_ns
+        cached = _properties_cache.get(self.script_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
         try:
             # Run the script with the parameter 'properties'
+            # Output is kept as bytes, json.loads() parses bytes directly
             result = subprocess.run(
                 [self.script_path, "properties"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
+                capture_output=True,
                 check=True  # Raises CalledProcessError if the command fails
             )
 
@@ -51,9 +86,11 @@ class ModuleWrapper():
             #     current_app.logger.debug(f"Script properties errors:\n{result.stderr}")
 
             # Parse the output into a JSON object
-            return json.loads(result.stdout)
+            properties = json.loads(result.stdout)
+            _properties_cache[self.script_path] = (mtime, properties)
+            return properties
         except subprocess.CalledProcessError as e:
-            current_app.logger.error(f"Error running script: {e.stderr}")
+            current_app.logger.error(f"Error running script: {e.stderr.decode('utf-8', errors='replace')}")
             raise
         except json.JSONDecodeError as e:
             current_app.logger.error(f"Error parsing JSON output: {e}")
@@ -78,14 +115,19 @@ class ModuleWrapper():
         if not target_path:
             raise FileNotFoundError(f"Target path not found for subject '{subject_name}' and study '{study_name}'")
 
+        # Use a recent result if the target hasn't changed
+        cache_key = (self.script_path, target_path)
+        mtime = os.stat(target_path).st_mtime_ns
+        cached = _status_cache.get(cache_key)
+        if cached is not None and cached[0] == mtime and time.monotonic() - cached[1] < STATUS_CACHE_SECONDS:
+            return cached[2]
+
         try:
             # Measure time for subprocess execution
             subprocess_start = time.time()
             result = subprocess.run(
                 [self.script_path, "status", "--target", target_path],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
+                capture_output=True,
                 check=True
             )
             current_app.logger.debug(f"Execution time for {self.name}/status: {time.time() - subprocess_start:.4f} seconds")
@@ -93,10 +135,12 @@ class ModuleWrapper():
             #  Parse JSON
             status = json.loads(result.stdout)
 
+            with _status_cache_lock:
+                _status_cache[cache_key] = (mtime, time.monotonic(), status)
             return status
         
         except subprocess.CalledProcessError as e:
-            current_app.logger.error(f"Error running script: {e.stderr}")
+            current_app.logger.error(f"Error running script: {e.stderr.decode('utf-8', errors='replace')}")
             
         except json.JSONDecodeError as e:
             current_app.logger.error(f"Error parsing JSON output: {e}")
@@ -120,11 +164,12 @@ class ModuleWrapper():
         cmd_line = [self.script_path, command, '--target', target_path] # Important: cmd is a list, not a string with spaces!
         current_app.logger.info(f"Running module command line: {cmd_line}")
 
-        # Run the command in a subprocess
+        # Run the command in a subprocess. The script's stdout is not captured: it goes 
+        # straight to our stdout as it is produced, instead of being held in memory and 
+        # decoded at the end. Only stderr is kept (as bytes) for the error message.
         result = subprocess.run(
-            cmd_line,   # Replace with your command and arguments
-            capture_output=True,            # Captures both stdout and stderr
-            text=True                       # Returns output as strings instead of bytes
+            cmd_line,
+            stderr=subprocess.PIPE
         )
         # If you need the pid you can replace subprocess.run() with subprocess.Popen(), but 
         # it takes a little more code
@@ -132,31 +177,23 @@ class ModuleWrapper():
         # Print the output and error messages
         self.print_subprocess_output(result)
 
-    def run_in_subprocess(self):
-        pm = ProcessModuleManager()
-        ipid = pm.spawn_process(tool=self, command='run', mode='sync')
-        current_app.logger.info(f"Started asynchronous process for {self.name} with command 'run', ipid={ipid}")
-
-
     def is_undoable(self):
         return self.properties.get('undoable', False)
 
         
     def print_subprocess_output(self, result):
         """
-        Helper function to print the output and error messages from a subprocess
-        This is used to print the output of the command run in the run method
+        Helper function to log the output and error messages from a subprocess
+        This is used to log the output of the command run in the run method
         """
+        stderr = result.stderr.decode('utf-8', errors='replace') if result.stderr else ''
         if result.returncode != 0:
-            print(f"Command failed with return code {result.returncode}")
-            raise Exception(f"Command failed: {result.stderr}")
+            current_app.logger.error(f"Command failed with return code {result.returncode}")
+            raise Exception(f"Command failed: {stderr}")
         else:
-            print(f"Command completed successfully with return code {result.returncode}")
-        if result.stdout:
-            print('Standard Output:')
-            print(result.stdout)
-        if result.stderr:
-            print('Standard Error:')
-            print(result.stderr)    
+            current_app.logger.info(f"Command completed successfully with return code {result.returncode}")
+        # stdout was already streamed as the command ran
+        if stderr:
+            current_app.logger.info(f"Standard Error:\n{stderr}")
         else: 
-            print('No errors.')
+            current_app.logger.debug('No errors.')
@@ -10,7 +10,8 @@ Under the proces root folder, there are two folders, running and completed.
 New processes are created in the running folder, with a folder for each process
 named using the OS's process id for that subprocess. Outputs from the process
 are saved as files in that folder. WHen the process completes the process folder
-is moved to the processes/completed folder. 
+is moved to the processes/completed folder. A background process that is still 
+waiting for a free thread has a folder named queued-<id> in the running folder instead.
 
 Key Features:
 - Spawns new processes for tools and commands.
@@ -24,8 +25,7 @@ Classes:
 methods for process management.
 
 Dependencies:
-- Python Standard Libraries: os, subprocess, shutil, glob, json, datetime, 
-multiprocessing, sys, io, threading
+- Python Standard Libraries: os, errno, subprocess, shutil, json, datetime, logging, threading, uuid, concurrent.futures
 - Custom Utilities: get_process_root_folder (from utils.py)
 
 Author: Patrick Bolan
@@ -34,13 +34,50 @@ Date: Aug 2025
 
 from utils import get_process_root_folder
 import os
+import errno
 import shutil
 import json
+import logging
 from datetime import datetime
-from multiprocessing import Process, Pipe
+from functools import lru_cache
 import subprocess
 import threading
-from flask import current_app
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, has_app_context
+
+@lru_cache(maxsize=4096)
+def _load_json_file(path, mtime_ns):
+    with open(path, 'r') as json_file:
+        return json.load(json_file)
+
+def read_json_file(path):
+    """
+    Reads a JSON file, reusing the parsed result if the file hasn't changed since it 
+    was last read. Process files are written once and then only read, so listing the
+    processes doesn't need to parse them again every time. Don't modify the result.
+    Raises FileNotFoundError if the file doesn't exist.
+    """
+    return _load_json_file(path, os.stat(path).st_mtime_ns)
+
+# Background (non-blocking) commands are waited on by threads from this pool. Each thread 
+# just waits on its subprocess, so this limits how many tools run at once. Extra commands
+# wait in the pool's queue until a thread is free. While they wait, their folder is in the
+# running folder as queued-<id> instead of <pid>, so they are listed and count as running.
+QUEUED_PREFIX = 'queued-'
+_background_executor = ThreadPoolExecutor(max_workers=2 * (os.cpu_count() or 1), 
+                                          thread_name_prefix='slug-process')
+
+def _get_logger():
+    # The app's logger if there is an app context, so it can be used later from pool threads
+    return current_app.logger if has_app_context() else logging.getLogger(__name__)
+
+# Index of the most recent process for each (subject_name, study_name, tool_name), per 
+# process root. Stored with the mtimes of the running and completed folders, which change
+# whenever a process folder is created or moved, so it's only rebuilt when needed.
+_process_index = {}
+_process_index_lock = threading.Lock()
+
 
 """ 
 ProcessModuleManager is responsible for managing the execution of tools in separate 
@@ -58,99 +95,187 @@ class ProcessModuleManager():
         self.process_root = get_process_root_folder()
         self.running_folder = os.path.join(self.process_root, 'running')
         self.completed_folder = os.path.join(self.process_root, 'completed')
+        self.folders = {
+            'running': self.running_folder,
+            'completed': self.completed_folder
+        }
         
-        # Create folders if they don't exist
-        if not os.path.exists(self.process_root):
-            os.makedirs(self.process_root)
-        if not os.path.exists(self.running_folder):
-            os.makedirs(self.running_folder)
-        if not os.path.exists(self.completed_folder):
-            os.makedirs(self.completed_folder)
+        # Create folders if they don't exist. makedirs creates the process root too
+        os.makedirs(self.running_folder, exist_ok=True)
+        os.makedirs(self.completed_folder, exist_ok=True)
 
 
 
     def run_commandline(self, command_list, context_dict, blocking=True):
         """
-        Run a command line command with captured output, time measurement, and postprocessing.
-        Output files are written into a subdirectory named after the process id inside output_dir.
-        The subdirectory is created immediately after Popen starts the process.
+        Run a command line command with output saved to files, time measurement, and postprocessing.
+        Output files are written into a subdirectory of the running folder named after the process id. 
+        stdout and stderr go straight to stdout.txt and stderr.txt in that folder while the 
+        process runs, instead of being collected in memory. When it finishes, completion.json
+        is written and the folder is moved to the completed folder.
 
         Args:
             command_list (list): Command and arguments as list, e.g. ['ls', '-l']
+            context_dict (dict): Saved as context.json. Needs tool_name and command.
             blocking (bool): If True, block until command completes.
-                            If False, run in background thread.
-            output_dir (str or None): Full path to folder where a subdirectory (named by pid) will be created
-                                    to save stdout.txt, stderr.txt, and completion.json.
-                                    If None, files are not written.
+                            If False, run in a background thread from a shared pool.
 
         Returns:
-            If blocking: tuple (stdout, stderr, returncode, start_time, end_time, duration_seconds)
-            If non-blocking: threading.Thread instance (command runs in background)
+            If blocking: tuple (returncode, start_time, end_time, duration_seconds)
+            If non-blocking: concurrent.futures.Future, whose result() is the blocking tuple.
+                            Until a pool thread picks it up, the process shows as running 
+                            with a pid of queued-<id>. Failures are logged.
         """
-        def _postprocess(stdout, stderr, returncode, start_time, end_time, pid):
-            duration = (end_time - start_time).total_seconds()
-
-            # Process dir is currently in running folder
-            this_process_dir = os.path.join(self.running_folder, str(pid))
-            os.makedirs(this_process_dir, exist_ok=True)
+        process_dir = self._prepare_process_folder(context_dict, queued=not blocking)
+        if blocking:
+            return self._run_in_folder(process_dir, command_list, context_dict)
 
-            with open(os.path.join(this_process_dir, 'stdout.txt'), 'w', encoding='utf-8') as f_out:
-                f_out.write(stdout or "")
+        # Nobody waits on the future, so log failures here. The pool threads have no app 
+        # context, so get the logger now
+        logger = _get_logger()
+        def _log_failure(future):
+            if not future.cancelled() and future.exception() is not None:
+                logger.error(f"Background command {command_list} failed: {future.exception()!r}")
 
-            with open(os.path.join(this_process_dir, 'stderr.txt'), 'w', encoding='utf-8') as f_err:
-                f_err.write(stderr or "")
+        future = _background_executor.submit(self._run_in_folder, process_dir, command_list, context_dict)
+        future.add_done_callback(_log_failure)
+        return future
 
-            completion_data = {
-                "returncode": returncode,
-                "start_time": start_time.isoformat(),
-                "end_time": end_time.isoformat(),
-                "duration": duration
-            }
-            with open(os.path.join(this_process_dir, 'completion.json'), 'w', encoding='utf-8') as f_json:
-                json.dump(completion_data, f_json, indent=4)
-
-            if stdout:
-                print("Standard Output:")
-                print(stdout)
-            if stderr:
-                print("Standard Error:")
-                print(stderr)
+    def run_commandline_chain(self, commands):
+        """
+        Runs several commands one after the other in the background, e.g. modules on one study
+        where each needs the outputs of the one before. All of them show up as queued right
+        away. If one fails (exception or non-zero return code), the ones after it are dropped.
+        Uses a single thread from the shared pool for the whole chain.
 
-            # Move the process folder to the completed folder   
-            shutil.move(this_process_dir, self.completed_folder)
-            # Logging doesn't work if this is threaded
-            #current_app.logger.debug(f"Process folder moved to completed: {os.path.join(self.completed_folder, str(pid))}")    
-
-        def _run():
-            start_time = datetime.now()
-            process = subprocess.Popen(
-                command_list,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            pid = process.pid
-            # Create output subdirectory immediately after starting process
-            this_process_dir = os.path.join(self.running_folder, str(pid))
-            os.makedirs(this_process_dir, exist_ok=True)
+        Args:
+            commands (list): (command_list, context_dict) tuples, as for run_commandline
 
+        Returns:
+            list of the queued-<id> process ids, one per command. Each is replaced by the 
+            real pid once that command starts.
+        """
+        process_dirs = []
+        try:
+            for command_list, context_dict in commands:
+                process_dirs.append(self._prepare_process_folder(context_dict, queued=True))
+        except Exception:
+            for process_dir in process_dirs:
+                shutil.rmtree(process_dir, ignore_errors=True)
+            raise
+
+        logger = _get_logger()
+        def _run_chain():
+            for position, (command_list, context_dict) in enumerate(commands):
+                failure = None
+                try:
+                    returncode = self._run_in_folder(process_dirs[position], command_list, context_dict)[0]
+                    if returncode != 0:
+                        failure = f"return code {returncode}"
+                except Exception as e:
+                    failure = repr(e)
+                if failure is not None:
+                    logger.error(f"Background command {command_list} failed: {failure}. "
+                                 f"Dropping the {len(commands) - position - 1} commands after it")
+                    for process_dir in process_dirs[position + 1:]:
+                        shutil.rmtree(process_dir, ignore_errors=True)
+                    return
+
+        _background_executor.submit(_run_chain)
+        return [os.path.basename(process_dir) for process_dir in process_dirs]
+
+    def _prepare_process_folder(self, context_dict, queued):
+        """
+        Makes the folder for a process in the running folder, with its context, before the 
+        command starts. A background command can wait in the pool's queue, and this way it 
+        already shows up as running (queued-<id>), so its tool can't be started twice. 
+        Returns the folder path.
+        """
+        # Hidden until the context is in it. Made with os.mkdir so it gets the app's umask
+        # like the other process folders (mkdtemp would make it private to this user)
+        folder_id = uuid.uuid4().hex
+        temp_dir = os.path.join(self.running_folder, f'.{folder_id}')
+        os.mkdir(temp_dir)
+        try:
             # Write a context file. Add the start to context dict, stream that to json
-            context_dict['start_time'] = start_time.isoformat()
+            context_dict['start_time'] = datetime.now().isoformat()
             context_dict['name'] = f'slug:{context_dict["tool_name"]}:{context_dict["command"]}'
-            with open(os.path.join(this_process_dir, 'context.json'), 'w') as json_file:
-                json.dump(context_dict, json_file, indent=4)
-
-            stdout, stderr = process.communicate()
-            end_time = datetime.now()
-            _postprocess(stdout, stderr, process.returncode, start_time, end_time, pid)
-            return stdout, stderr, process.returncode, start_time, end_time, (end_time - start_time).total_seconds()
-
-        if blocking:
-            return _run()
-        else:
-            thread = threading.Thread(target=_run)
-            thread.start()
-            return thread
+            with open(os.path.join(temp_dir, 'context.json'), 'w') as json_file:
+                json_file.write(json.dumps(context_dict, indent=4))
+            if not queued:
+                return temp_dir  # Starts right away, no need to show it as queued
+            queued_dir = os.path.join(self.running_folder, f'{QUEUED_PREFIX}{folder_id}')
+            os.rename(temp_dir, queued_dir)
+            return queued_dir
+        except Exception:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+
+    def _run_in_folder(self, process_dir, command_list, context_dict):
+        """
+        Runs a command in a folder from _prepare_process_folder and waits for it. Returns
+        (returncode, start_time, end_time, duration_seconds)
+        """
+        start_time = datetime.now()
+        # The pid isn't known until the process starts, so the output files are opened 
+        # in the prepared folder, which is renamed once the pid is known
+        try:
+            with open(os.path.join(process_dir, 'stdout.txt'), 'wb') as f_out, \
+                 open(os.path.join(process_dir, 'stderr.txt'), 'wb') as f_err:
+                # No text=True, the output goes to the files as bytes without being decoded
+                process = subprocess.Popen(
+                    command_list,
+                    stdout=f_out,
+                    stderr=f_err
+                )
+            pid_str = str(process.pid)
+
+            # It may have been queued for a while, so update the start time
+            context_dict['start_time'] = start_time.isoformat()
+            with open(os.path.join(process_dir, 'context.json'), 'w') as json_file:
+                json_file.write(json.dumps(context_dict, indent=4))
+
+            # Now it shows up as running under its pid, with its context already there
+            this_process_dir = os.path.join(self.running_folder, pid_str)
+            if os.path.isdir(this_process_dir):
+                shutil.rmtree(this_process_dir)  # Left over from an old process with the same pid
+            os.rename(process_dir, this_process_dir)
+        except Exception:
+            # E.g. the script doesn't exist. Don't leave the folder behind as running
+            shutil.rmtree(process_dir, ignore_errors=True)
+            raise
+
+        returncode = process.wait()
+        end_time = datetime.now()
+        self._postprocess(returncode, start_time, end_time, pid_str)
+        return returncode, start_time, end_time, (end_time - start_time).total_seconds()
+
+    def _postprocess(self, returncode, start_time, end_time, pid_str):
+        duration = (end_time - start_time).total_seconds()
+
+        # Process dir is currently in running folder
+        this_process_dir = os.path.join(self.running_folder, pid_str)
+
+        # start_time is already in context.json
+        completion_data = {
+            "returncode": returncode,
+            "end_time": end_time.isoformat(),
+            "duration": duration
+        }
+        # json.dumps then one write, instead of json.dump writing it piece by piece
+        with open(os.path.join(this_process_dir, 'completion.json'), 'w', encoding='utf-8') as f_json:
+            f_json.write(json.dumps(completion_data, indent=4))
+
+        # Move the process folder to the completed folder. Both are under the process 
+        # root, so normally this is a single rename. shutil.move only if that can't work
+        try:
+            os.rename(this_process_dir, os.path.join(self.completed_folder, pid_str))
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.move(this_process_dir, self.completed_folder)
+        # Logging doesn't work if this is threaded
+        #current_app.logger.debug(f"Process folder moved to completed: {os.path.join(self.completed_folder, pid_str)}")    
 
 
     def get_process_id(self, subject_name, study_name, tool_name):
@@ -158,43 +283,98 @@ class ProcessModuleManager():
         Search for a process by subject_name, study_name, and tool_name
         Returns the pid of the most recent process if found, otherwise None.
         """
+        return self.get_process_ids(subject_name, study_name, [tool_name])[tool_name]
+
+    def get_process_ids(self, subject_name, study_name, tool_names):
+        """
+        Same as get_process_id, but for a list of tools. Uses the process index, so the
+        process folders are only scanned when they have changed.
+        Returns a dict of tool_name: pid of the most recent process, or None if not found.
+        Running processes take precedence over completed ones.
+        """
+        index = self.get_process_index()
+        process_ids = dict()
+        for tool_name in tool_names:
+            entry = index.get((subject_name, study_name, tool_name))
+            process_ids[tool_name] = entry[2] if entry else None
+        return process_ids
+
+    def get_folders_state(self):
+        """
+        Returns the modification times of the running and completed folders. They change 
+        whenever a process starts (its folder is added to running) or finishes (moved to 
+        completed), or logs are cleared.
+        """
+        return (os.stat(self.running_folder).st_mtime_ns, 
+                os.stat(self.completed_folder).st_mtime_ns)
+
+    def get_process_index(self):
+        """
+        Returns a dict of (subject_name, study_name, tool_name): (is_running, start_time, pid)
+        for the most recent process of each. Cached until the running or completed folder changes.
+        """
+        folders_key = self.get_folders_state()
+        with _process_index_lock:
+            cached = _process_index.get(self.process_root)
+            if cached is not None and cached[0] == folders_key:
+                return cached[1]
+
+        index = dict()
+        complete = True
         for folder_type in ['running', 'completed']:
-            processes = self.get_process_dicts(folder_type=folder_type, sort_order='most_recent')
-
-            for process_info in processes:  
-                if (process_info['subject_name'] == subject_name and
-                    process_info['study_name'] == study_name and
-                    process_info['name'].startswith(f'slug:{tool_name}')):
-                    return process_info['pid']
-        return None
+            is_running = folder_type == 'running'
+            with os.scandir(self.get_folder(folder_type)) as entries:
+                for entry in entries:
+                    if not entry.is_dir() or entry.name.startswith('.'):
+                        continue
+                    try:
+                        context = read_json_file(os.path.join(entry.path, 'context.json'))
+                    except Exception:
+                        complete = False  # Not written yet? Don't cache, check again next time
+                        continue
+                    key = (context.get('subject_name'), context.get('study_name'), context.get('tool_name'))
+                    value = (is_running, context.get('start_time') or '', entry.name)
+                    if key not in index or value > index[key]:
+                        index[key] = value
+
+        if complete:
+            with _process_index_lock:
+                _process_index[self.process_root] = (folders_key, index)
+        return index
                     
     def is_running(self, pid):
-        process_info = self.get_process_dict(pid)
-        if process_info is not None and ('status' in process_info) and process_info['status'] == 'running': 
-            return True
-        else:
+        # A process is running while its folder is in the running folder. No need to read
+        # its files for that
+        if pid is None:
             return False
+        return os.path.isdir(os.path.join(self.running_folder, str(pid)))
 
-    def get_process_dict(self, pid):
+    def get_process_dict(self, pid, status=None, folder=None):
         """
         Returns a dictionary representing the process with the given pid.
         The dictionary includes name, pid, subject_name, study_name, command, start_time,
         return_code, end_time, and duration_s.
         If no such process is found, returns None.
+        If the caller already knows the status ('running' or 'completed') and the process 
+        folder, pass them in and the folders aren't searched.
         """
         if pid is None:
             return None
 
-        # First look in running, then completed
-        process_folder = os.path.join(self.running_folder, str(pid))        
-        if os.path.isdir(process_folder):
-            status = 'running'
-        else:        
-            process_folder = os.path.join(self.completed_folder, str(pid))
-            if os.path.isdir(process_folder): 
-                status = 'completed' 
-            else:
-                return None       
+        if folder is not None and status is not None:
+            process_folder = folder
+        else:
+            # First look in running, then completed
+            pid_str = str(pid)
+            process_folder = os.path.join(self.running_folder, pid_str)
+            if os.path.isdir(process_folder):
+                status = 'running'
+            else:        
+                process_folder = os.path.join(self.completed_folder, pid_str)
+                if os.path.isdir(process_folder): 
+                    status = 'completed' 
+                else:
+                    return None       
         #current_app.logger.debug(f'For pid {pid}, found in folder {status}')
 
         context_file = os.path.join(process_folder, 'context.json')
@@ -202,66 +382,79 @@ class ProcessModuleManager():
         process_info = dict() # Start with empty dict
 
         try:
-            with open(context_file, 'r') as json_file:
-                process_context = json.load(json_file)
-                process_info = {
-                    'name': process_context.get('name', 'N/A'),
-                    'status': status,
-                    'pid': pid,
-                    'subject_name': process_context.get('subject_name', 'N/A'),
-                    'study_name': process_context.get('study_name', 'N/A'),
-                    'start_time': process_context.get('start_time', 'N/A'),
-                }
+            process_context = read_json_file(context_file)
+            process_info = {
+                'name': process_context.get('name', 'N/A'),
+                'status': status,
+                'pid': pid,
+                'subject_name': process_context.get('subject_name', 'N/A'),
+                'study_name': process_context.get('study_name', 'N/A'),
+                'start_time': process_context.get('start_time', 'N/A'),
+            }
         except Exception as e:
-            pass
+            # The folder may have just moved from running to completed
+            if not os.path.isdir(process_folder):
+                return None
             #current_app.logger.error(f"Error reading context.json in {process_folder}: {e}")
             #return None
 
         # If the process is completed, add completion details
         try:
-            with open(completion_file, 'r') as json_file:
-                completion_context = json.load(json_file)
-                process_info['returncode'] = completion_context.get('returncode', 'N/A')
-                process_info['start_time'] = completion_context.get('start_time', 'N/A')
-                process_info['end_time'] = completion_context.get('end_time', 'N/A')
-                process_info['duration'] = completion_context.get('duration', 'N/A')
+            completion_context = read_json_file(completion_file)
+            process_info['returncode'] = completion_context.get('returncode', 'N/A')
+            process_info['end_time'] = completion_context.get('end_time', 'N/A')
+            process_info['duration'] = completion_context.get('duration', 'N/A')
         except FileNotFoundError:
             # If completion file does not exist, it means the process is still running
             process_info['returncode'] = ''
-            #process_info['start_time'] = '' # Dont overwrite this
             process_info['end_time'] = ''
             process_info['duration'] = ''
             
 
         return process_info
 
+    def get_folder(self, folder_type):
+        """
+        Returns the folder path for a folder_type of 'running' or 'completed'.
+        """
+        try:
+            return self.folders[folder_type]
+        except KeyError:
+            raise ValueError("Invalid folder_type. Must be 'running' or 'completed'.")
+
     def get_process_dicts(self, folder_type='running', sort_order='most_recent'):
         """
         Returns a list of dictionaries representing all processes in the specified folder.
         Each dictionary includes name, pid, subject_name, study_name, command, and start-time.
         :param folder_type: Either 'running' or 'completed' to specify which folder to look in.
+        :param sort_order: 'most_recent', 'oldest' (or anything else), or None for unsorted.
         """
-        if folder_type == 'running':
-            folder_path = self.running_folder
-        elif folder_type == 'completed':
-            folder_path = self.completed_folder
-        else:
-            raise ValueError("Invalid folder_type. Must be 'running' or 'completed'.")
+        folder_path = self.get_folder(folder_type)
+
+        # Skip the hidden temporary folders of processes that are just starting
+        with os.scandir(folder_path) as entries:
+            process_folders = [(entry.name, entry.path) for entry in entries 
+                               if entry.is_dir() and not entry.name.startswith('.')]
+
+        # The status and folder are known here, so get_process_dict doesn't have to look
+        def _get(process_folder):
+            pid, path = process_folder
+            return self.get_process_dict(pid, status=folder_type, folder=path)
 
+        # Reading the process files is mostly waiting on the file system, so read them in 
+        # parallel. A process can finish and move while this runs, those come back as None
         processes = []
-        for folder_name in os.listdir(folder_path):
-            processes.append( self.get_process_dict(folder_name) )
+        if process_folders:
+            with ThreadPoolExecutor(max_workers=min(32, len(process_folders))) as executor:
+                processes = [p for p in executor.map(_get, process_folders) if p is not None]
 
         #current_app.logger.debug(f'Found {len(processes)} processes in {folder_type} folder: {processes}')
 
-        if processes:
-            if sort_order == 'most_recent':
-                # Sort processes by most recent start_time  
-                processes = sorted(processes, key=lambda x: x['start_time'], reverse=True)
-            else:
-                # Sort processes by oldest start_time
-                processes = sorted(processes, key=lambda x: x['start_time'])  
-            pass
+        # Sort by start_time, most recent or oldest first. ISO timestamps sort as strings.
+        # In place, and a missing start_time (no readable context.json) sorts as oldest.
+        # sort_order=None skips sorting, for callers that don't care about the order
+        if sort_order is not None:
+            processes.sort(key=lambda x: x.get('start_time') or '', reverse=(sort_order == 'most_recent'))
 
         return processes
     
@@ -270,18 +463,17 @@ class ProcessModuleManager():
         Clears the logs of all processes in the specified folder.
         :param folder_type: Either 'running' or 'completed' to specify which folder to clear.
         """
-        if folder_type == 'running':
-            folder_path = self.running_folder
-        elif folder_type == 'completed':
-            folder_path = self.completed_folder
-        else:
-            raise ValueError("Invalid folder_type. Must be 'running' or 'completed'.")
-
-        for process_folder in os.listdir(folder_path):
-            process_folder_path = os.path.join(folder_path, process_folder)
-            if os.path.isdir(process_folder_path):
-                shutil.rmtree(process_folder_path)
-                current_app.logger.info(f"Deleted folder: {process_folder_path}")
+        folder_path = self.get_folder(folder_type)
 
+        with os.scandir(folder_path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    shutil.rmtree(entry.path)
+                    current_app.logger.info(f"Deleted folder: {entry.path}")
 
 
+# The manager keeps no per-request state (the caches above are module-level), so one 
+# instance is shared. Created on first use, so the config is loaded by then
+@lru_cache(maxsize=1)
+def get_process_manager():
+    return ProcessModuleManager()
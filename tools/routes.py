@@ -1,13 +1,25 @@
-from flask import Blueprint, render_template, abort, redirect, url_for, request, current_app
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import Blueprint, render_template, abort, redirect, url_for, request, current_app, jsonify, Response
 
-from tools.utils import execute_module_commandline
+from tools.utils import execute_module_commandline, execute_module_commandlines
 #from tools.process_manager import ProcessManager
-from tools.process_module_manager import ProcessModuleManager
-from utils import get_process_file_path, get_file_tree, get_study_path, get_subject_path, get_data_folder
+from tools.process_module_manager import get_process_manager
+from utils import get_file_tree, get_cached_file_tree, get_study_path, get_subject_path, get_data_folder
 
 
 tools_bp = Blueprint('tools_bp', __name__)
 
+# Target path of a tool command: the study, the subject, or the whole data folder
+def get_target_path(subject_name, study_name):
+    if subject_name and study_name:
+        return get_study_path(subject_name, study_name)
+    elif subject_name:
+        return get_subject_path(subject_name)
+    else:   
+        return get_data_folder()
+
 # Tool commands. Supports study-level, subject-level, and project-level tools.
 @tools_bp.route('/tools/<tool_name>/<command>/', methods=['POST'])
 @tools_bp.route('/tools/<tool_name>/<command>/subjects/<subject_name>/', methods=['POST'])
@@ -15,12 +27,7 @@ tools_bp = Blueprint('tools_bp', __name__)
 def tool_command(tool_name, command, subject_name=None, study_name=None):
 
     # Calculate the target paths
-    if subject_name and study_name:
-        target_path = get_study_path(subject_name, study_name)
-    elif subject_name:
-        target_path = get_subject_path(subject_name)
-    else:   
-        target_path = get_data_folder()
+    target_path = get_target_path(subject_name, study_name)
 
     # Print the basic tool information
     current_app.logger.debug(f"Tool: {tool_name}, Command: {command}, Subject: {subject_name}, Study: {study_name}, target_path: {target_path}")
@@ -34,50 +41,129 @@ def tool_command(tool_name, command, subject_name=None, study_name=None):
     return f"Tool '{tool_name}' executed command '{command}' for target path '{target_path}' and options '{options}'.", 200
 
 
+# Several tool commands in one request. Expects JSON like 
+#   {"jobs": [{"tool_name": "...", "command": "run", "subject_name": "...", "study_name": "...", 
+#              "options": {"execution": "background"}}, ...]}
+# subject_name, study_name, and options are optional, as in the single-command routes. 
+# Bulk jobs always run in the background, and this returns as soon as they are submitted.
+# Jobs for the same subject/study run one after the other in the order given, since later
+# modules usually need the outputs of earlier ones. If one fails, the rest for that target 
+# are dropped. Jobs for different targets run in parallel. 
+# Returns a JSON list with the status of each job: 'queued' with its process_id (queued-<id>,
+# which shows on the processes page until the job starts), 'error', or 'skipped'.
+@tools_bp.route('/tools/bulk', methods=['POST'])
+def tool_bulk():
+    data = request.get_json(silent=True)
+    jobs = data.get('jobs') if isinstance(data, dict) else None
+    if not isinstance(jobs, list):
+        abort(400, description="Expected JSON with a 'jobs' list.")
+
+    for job in jobs:
+        if not isinstance(job, dict) or not job.get('tool_name') or not job.get('command'):
+            abort(400, description="Each job needs a tool_name and a command.")
+        job['target'] = get_target_path(job.get('subject_name'), job.get('study_name'))
+
+    current_app.logger.debug(f"Bulk tool request with {len(jobs)} jobs")
+    results = execute_module_commandlines(jobs)
+
+    return jsonify(results), 200
+
+
 @tools_bp.route('/processes')
 def processes():
-    # Create an instance of ProcessManager
-    process_manager = ProcessModuleManager()
+    # The shared ProcessModuleManager
+    process_manager = get_process_manager()
 
-    # Get the list of running and completed processes
-    running_processes = process_manager.get_process_dicts(folder_type='running')
-    completed_processes = process_manager.get_process_dicts(folder_type='completed')
+    # The page listens to /processes/stream and reloads when this changes. Taken before 
+    # listing, so a change while listing also triggers a reload
+    state = get_process_state_token(process_manager)
+
+    # Get the list of running and completed processes. They're in separate folders, so
+    # read both at the same time
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        running_future = executor.submit(process_manager.get_process_dicts, folder_type='running')
+        completed_future = executor.submit(process_manager.get_process_dicts, folder_type='completed')
+        running_processes = running_future.result()
+        completed_processes = completed_future.result()
 
     # Render the processes.html template with both lists
     return render_template('processes.html', 
                            running_processes=running_processes, 
-                           completed_processes=completed_processes)
+                           completed_processes=completed_processes,
+                           state=state)
+
+# How often the process stream checks the process folders, and how long one stream lasts.
+# The browser's EventSource reconnects by itself when a stream ends, so a closed tab 
+# doesn't keep a server thread forever
+PROCESS_STREAM_POLL_SECONDS = 1.0
+PROCESS_STREAM_MAX_SECONDS = 300
+PROCESS_STREAM_KEEPALIVE_SECONDS = 15
+
+def get_process_state_token(process_manager):
+    return '-'.join(str(t) for t in process_manager.get_folders_state())
+
+# Server-sent events for the processes page. Sends a 'changed' event when a process starts
+# or finishes (the running or completed folder changes) compared to the state the page 
+# was rendered with (?since=...). Only two stats per check, no process files are read
+@tools_bp.route('/processes/stream')
+def processes_stream():
+    process_manager = get_process_manager()
+    since = request.args.get('since')
+
+    def event_stream():
+        last_state = since
+        started = time.monotonic()
+        last_sent = started
+        while time.monotonic() - started < PROCESS_STREAM_MAX_SECONDS:
+            state = get_process_state_token(process_manager)
+            if state != last_state:
+                last_state = state
+                last_sent = time.monotonic()
+                yield f'event: changed\ndata: {state}\n\n'
+            elif time.monotonic() - last_sent > PROCESS_STREAM_KEEPALIVE_SECONDS:
+                # A comment line. Keeps the connection open, and notices closed tabs
+                last_sent = time.monotonic()
+                yield ': keep-alive\n\n'
+            time.sleep(PROCESS_STREAM_POLL_SECONDS)
+
+    return Response(event_stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
 
 @tools_bp.route('/process/<pid>')
 def process_info(pid):
-    # Create an instance of ProcessManager
-    process_manager = ProcessModuleManager()
+    # The shared ProcessModuleManager
+    process_manager = get_process_manager()
 
     # Get process information
     process_info = process_manager.get_process_dict(pid)
     current_app.logger.debug(f"Process info for PID {pid}: {process_info}")
 
-    # Generate file tree
-    file_tree = get_file_tree(get_process_file_path(pid))
-
     # If the process does not exist, return a 404 error
     if not process_info:
         abort(404, description=f"Process with PID {pid} not found.")
 
+    # Generate file tree. A completed process folder doesn't change anymore, so its tree
+    # is cached. A running one is walked every time, the tool may still be adding files
+    process_folder = os.path.join(process_manager.get_folder(process_info['status']), str(pid))
+    if process_info['status'] == 'completed':
+        file_tree = get_cached_file_tree(process_folder)
+    else:
+        file_tree = get_file_tree(process_folder)
+
     return render_template('process.html', 
                            process_info=process_info, 
                            file_tree=file_tree)
 
 @tools_bp.route('/clear-running-logs', methods=['POST'])
 def clear_running_logs():
-    pm = ProcessModuleManager()
+    pm = get_process_manager()
     pm.clear_logs(folder_type='running')
 
     return redirect(url_for('tools_bp.processes'))
 
 @tools_bp.route('/clear-completed-logs', methods=['POST'])
 def clear_completed_logs():
-    pm = ProcessModuleManager()
+    pm = get_process_manager()
     pm.clear_logs(folder_type='completed')
 
     return redirect(url_for('tools_bp.processes'))
\ No newline at end of file
@@ -1,8 +1,9 @@
 from flask import current_app
 from utils import get_subject_type, get_study_type, get_module_folder, get_study_path
-from tools.module_wrapper import ModuleWrapper
-from tools.process_module_manager import ProcessModuleManager
+from tools.module_wrapper import ModuleWrapper, clear_status_cache
+from tools.process_module_manager import get_process_manager, QUEUED_PREFIX
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 def get_module_configuration(subject_name, study_name):
     """
@@ -53,15 +54,23 @@ def get_tool_menu(subject_name, study_name):
     if module_configuration is None:
         return None
 
-    tool_menu = []
-    for module_name in module_configuration:
+    # One process manager and one scan of the process folders for the whole menu
+    pm = get_process_manager()
+    process_ids = pm.get_process_ids(subject_name, study_name, list(module_configuration))
 
-        # Great. Here is where you instantiate this object, get its status dict.
-        # Append status dict to toolset
+    # Great. Here is where you instantiate these objects and get their status dicts.
+    wrappers = {}
+    for module_name in module_configuration:
         wrapper = get_module_wrapper(module_name)
         if not wrapper:
             raise ValueError(f"Module wrapper not found for tool '{module_name}'")
-        status = wrapper.get_status(subject_name, study_name)
+        wrappers[module_name] = wrapper
+    statuses = get_module_statuses(wrappers, subject_name, study_name)
+
+    tool_menu = []
+    for module_name in module_configuration:
+        wrapper = wrappers[module_name]
+        status = statuses[module_name]
 
         # Check values from dicts, make sure they are there
         status_string = status.get("state", "unknown")
@@ -79,15 +88,17 @@ def get_tool_menu(subject_name, study_name):
             command = None
 
         # Go find PID
-        pm = ProcessModuleManager()
-        pid = pm.get_process_id(subject_name, study_name, module_name)
+        pid = process_ids[module_name]
         # Note that the command line "status" request doesn't know about how slug
         # manages running processes, it just looks at the files. So if the process 
         # is started and has started creating files, the status is unclear. But here,
         # I know the status if it's in the running folder. Overwrite.
         if pm.is_running(pid):
             status_string = "running"
-            rationale_string = f"{module_name} is running"
+            if str(pid).startswith(QUEUED_PREFIX):
+                rationale_string = f"{module_name} is queued, waiting for a free worker"
+            else:
+                rationale_string = f"{module_name} is running"
             command = None
 
         # Cool. Now from status prepare a dict to give to the web interface.
@@ -127,6 +138,27 @@ def get_tool_menu(subject_name, study_name):
     return tool_menu
 
 
+def get_module_statuses(wrappers, subject_name, study_name):
+    """
+    Calls get_status on several module wrappers at once. Each status call runs the 
+    module script in a subprocess, so running them in threads lets them overlap 
+    instead of waiting for each one in turn.
+    :param wrappers: dict of module name: ModuleWrapper
+    :return: dict of module name: status dict
+    """
+    if not wrappers:
+        return {}
+
+    app = current_app._get_current_object()
+    def _get_status(wrapper):
+        # get_status logs with current_app, so each thread needs the app context
+        with app.app_context():
+            return wrapper.get_status(subject_name, study_name)
+
+    with ThreadPoolExecutor(max_workers=len(wrappers)) as executor:
+        return dict(zip(wrappers, executor.map(_get_status, wrappers.values())))
+
+
 # Global cache for ModuleWrapper instances
 _module_wrapper_cache = {}
 
@@ -169,6 +201,30 @@ def get_module_wrapper(tool_name):
 def execute_module_commandline(tool_name, command, subject_name, study_name, target, options):
     current_app.logger.debug(f"execute_module_commandline: {tool_name}, command: {command}, target: {target}, options: {options}")
 
+    command_list, context_dict = get_module_commandline(tool_name, command, subject_name, study_name, target, options)
+
+    # Execution mode: in-process or background
+    if options.get('execution', 'in-process') == 'in-process':
+        blocking = True
+    else:
+        blocking = False
+    
+    # Command line execution is managed with the ProcessModuleManager
+    pm = get_process_manager()
+    result = pm.run_commandline(command_list, context_dict, blocking=blocking) 
+
+    # The command may have changed the target, so don't reuse cached status for it
+    clear_status_cache(target)
+    
+    # (returncode, start_time, end_time, duration) if in-process, a Future if background
+    return result
+
+
+def get_module_commandline(tool_name, command, subject_name, study_name, target, options):
+    """
+    Builds the command list and the process context for running a module command.
+    Raises ValueError if the module isn't known.
+    """
     module_wrapper = get_module_wrapper(tool_name)
     if module_wrapper is None:
         raise ValueError(f"Module wrapper not found for tool '{tool_name}'")
@@ -183,23 +239,74 @@ def execute_module_commandline(tool_name, command, subject_name, study_name, tar
         'options': options
     }    
 
-    # Execution mode: in-process or background
-    if options.get('execution', 'in-process') == 'in-process':
-        blocking = True
-    else:
-        blocking = False
-
     # Other options except execution should be added to the command_list
     for option_name, option_value in options.items():
-        if option_name != 'execution':  # Skip execution mode, already handled
+        if option_name != 'execution':  # Skip execution mode, handled by the caller
             command_list.append(f'--{option_name}')
             command_list.append(str(option_value))
             
     current_app.logger.debug(f"Executing command list: {' '.join(command_list)}")
-    
-    # Command line execution is managed with the ProcessModuleManager
-    pm = ProcessModuleManager()
-    pm.run_commandline(command_list, context_dict, blocking=blocking) 
-    
-    return None
+    return command_list, context_dict
+
+
+def execute_module_commandlines(jobs):
+    """
+    Submits several module commands, as sent to the bulk tools endpoint, and returns right
+    away. They always run in the background. Modules for one target usually form a chain 
+    (e.g. nii-converter, then template-registration, then reslice-mask), so the jobs for 
+    each target run one at a time in the order given, and if one fails the rest for that 
+    target are dropped. Different targets run in parallel.
+    :param jobs: list of dicts with tool_name, command, subject_name, study_name, target and options
+    :return: list with a result dict for each job, in the same order. status is 'queued' 
+             (with the process_id it shows up as until it starts), 'error', or 'skipped'
+    """
+    # Job indexes grouped by target, in the order given
+    groups = dict()
+    for index, job in enumerate(jobs):
+        groups.setdefault(job['target'], []).append(index)
+    results = [None] * len(jobs)
+
+    pm = get_process_manager()
+    for target, indexes in groups.items():
+        commands = []
+        chain_indexes = []
+        broken = False
+        for index in indexes:
+            job = jobs[index]
+            result = {key: job.get(key) for key in ('tool_name', 'command', 'subject_name', 'study_name')}
+            results[index] = result
+            if target is None:
+                result['status'] = 'error'
+                result['error'] = "Subject or study not found"
+            elif broken:
+                result['status'] = 'skipped'
+                result['error'] = "An earlier job for the same target could not be submitted"
+            else:
+                try:
+                    commands.append(get_module_commandline(job['tool_name'], job['command'], job.get('subject_name'), 
+                                                           job.get('study_name'), target, job.get('options') or {}))
+                    chain_indexes.append(index)
+                except Exception as e:
+                    current_app.logger.error(f"Bulk job {result} failed: {e}")
+                    result['status'] = 'error'
+                    result['error'] = str(e)
+                    broken = True
+
+        if not commands:
+            continue
+        try:
+            process_ids = pm.run_commandline_chain(commands)
+        except Exception as e:
+            current_app.logger.error(f"Could not submit bulk jobs for {target}: {e}")
+            for index in chain_indexes:
+                results[index]['status'] = 'error'
+                results[index]['error'] = str(e)
+            continue
+        for index, process_id in zip(chain_indexes, process_ids):
+            results[index]['status'] = 'queued'
+            results[index]['process_id'] = process_id
+
+        # The commands will change the target, so don't reuse cached status for it
+        clear_status_cache(target)
 
+    return results
@@ -1,8 +1,13 @@
 import os
 import re
-import pydicom
+from functools import lru_cache
 from config import Config
-from flask import g 
+from flask import g, current_app
+
+# Folder naming conventions, compiled once
+SUBJECT_PATTERN = re.compile(r'^[A-Z]{3}-\d{4}$')  # Pattern for XXX-0000
+STUDY_PATTERN = re.compile(r'MR-\d{8}$')  # Pattern for MR-YYYYMMDD
+SERIES_FOLDER_PATTERN = re.compile(r'MR-SE(\d{3,5})-')  # Match 3 to 5 digits
 
 # Utility functions to retrieve folder paths
 def get_data_folder():
@@ -13,10 +18,16 @@ def get_data_folder():
     elif data_source == 'live':
         return config.get('data_folder')
 
+# Like the module folder, the process root only comes from the config, so it can be cached.
+# It's also used to build process file paths
+@lru_cache(maxsize=1)
 def get_process_root_folder():
     config = Config()
     return config.get('process_root_folder', '/default/process/root/folder')
 
+# The module folder only comes from the config, so it can be cached. It's looked up 
+# for every module wrapper and tool menu.
+@lru_cache(maxsize=1)
 def get_module_folder():
     config = Config()
     return config.get('module_folder', '/default/module/folder')
@@ -25,20 +36,24 @@ def get_web_browser_path():
     config = Config()
     return config.get('web_browser_path', '/usr/bin/firefox')
 
+# Folder listings, cached by the folder's modification time. Adding, removing or renaming
+# a subject or study changes the parent folder's time, so the listing is read again then
+@lru_cache(maxsize=1024)
+def _list_folders_matching(path, mtime_ns, pattern):
+    with os.scandir(path) as entries:
+        names = [e.name for e in entries if pattern.match(e.name) and e.is_dir()]
+    names.sort()
+    return tuple(names)
+
 def get_all_subjects():
-    pattern = re.compile(r'^[A-Z]{3}-\d{4}$')  # Pattern for XXX-0000  
-    subjects = [d for d in os.listdir(get_data_folder()) if os.path.isdir(os.path.join(get_data_folder(), d)) and pattern.match(d)]
-    subjects.sort()
-    return subjects
+    data_folder = get_data_folder()
+    return list(_list_folders_matching(data_folder, os.stat(data_folder).st_mtime_ns, SUBJECT_PATTERN))
 
 def get_studies_for_subject(subject_name):
     subject_path = get_subject_path(subject_name)
-    if not os.path.isdir(subject_path):
+    if not subject_path:
         return []
-    pattern = re.compile(r'MR-\d{8}$')  # Pattern for MR-YYYYMMDD
-    studies = [d for d in os.listdir(subject_path) if os.path.isdir(os.path.join(subject_path, d)) and pattern.match(d)]
-    studies.sort()
-    return studies
+    return list(_list_folders_matching(subject_path, os.stat(subject_path).st_mtime_ns, STUDY_PATTERN))
 
 def get_subject_path(subject_name):
     subject_path = os.path.join(get_data_folder(), subject_name)
@@ -97,9 +112,9 @@ def get_study_type(subject_name, study_name):
     return f"{subject_type}-mri"
 
 def get_process_file_path(process_id, file_relative_path=None):
-    from tools.process_module_manager import ProcessModuleManager
+    from tools.process_module_manager import get_process_manager
 
-    pm = ProcessModuleManager()
+    pm = get_process_manager()
     process_info = pm.get_process_dict(process_id)
     if process_info is None:
         return None
@@ -116,8 +131,20 @@ def get_process_file_path(process_id, file_relative_path=None):
     return return_path
 
 
+@lru_cache(maxsize=256)
+def _read_dicom_header(file_path, mtime_ns, specific_tags):
+    """
+    Reads a DICOM header. Cached, so the same sample file isn't re-read on every page 
+    load. The modification time is part of the key so a changed file is read again.
+    """
+    import pydicom  # Imported here, it's slow to load and only needed for this
+    # Only the header is used, so don't read the pixel data
+    tags = list(specific_tags) if specific_tags else None
+    return pydicom.dcmread(file_path, stop_before_pixels=True, specific_tags=tags)
+
 # Get some DICOM header information
-def get_sample_dicom_header(subject_name, study_name, series_name=None):
+# If specific_tags is given (list of keywords), only those elements are read from the file
+def get_sample_dicom_header(subject_name, study_name, series_name=None, specific_tags=None):
     study_path = get_study_path(subject_name, study_name)
     if not study_path:
         return None
@@ -126,27 +153,27 @@ def get_sample_dicom_header(subject_name, study_name, series_name=None):
         return None
     
     if series_name is None:
-        # Grab a dicom folder
-        dicom_folders = [f for f in os.listdir(dicom_path) if f.startswith('MR-SE')]
-        if not dicom_folders:
+        # Grab the first dicom folder. Stop scanning as soon as one is found, series 
+        # folders can hold thousands of files
+        with os.scandir(dicom_path) as entries:
+            sample_folder = next((e.path for e in entries if e.name.startswith('MR-SE')), None)
+        if sample_folder is None:
             return None
-
-        # Look in the first folder
-        sample_folder = os.path.join(dicom_path, dicom_folders[0])  # Sort to get a consistent sample
     else:
         sample_folder = os.path.join(dicom_path, series_name)
         if not os.path.isdir(sample_folder):
             return None
 
-    dicom_files = [f for f in os.listdir(sample_folder) if f.lower().endswith('.dcm')]
-    if not dicom_files:
+    with os.scandir(sample_folder) as entries:
+        sample_file = next((e.path for e in entries if e.name.lower().endswith('.dcm')), None)
+    if sample_file is None:
         return None
-    sample_file = os.path.join(sample_folder, dicom_files[0])
     try:
-        dicom_data = pydicom.dcmread(sample_file)
-        return dicom_data
+        mtime = os.stat(sample_file).st_mtime_ns
+        tags = tuple(specific_tags) if specific_tags else None
+        return _read_dicom_header(sample_file, mtime, tags)
     except Exception as e:
-        print(f"Error reading DICOM file {sample_file}: {e}")
+        current_app.logger.warning(f"Error reading DICOM file {sample_file}: {e}")
         return None
     
 
@@ -158,25 +185,42 @@ def get_file_tree(path):
     """
     tree = []
     if os.path.isdir(path):
-        for entry in sorted(os.listdir(path)):
-            if entry.startswith('.'):  # Ignore files or folders starting with a period
+        # scandir gets the file type with the directory listing, so there's no extra
+        # stat per entry to tell folders from files
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        for entry in entries:
+            if entry.name.startswith('.'):  # Ignore files or folders starting with a period
                 continue
-            full_path = os.path.join(path, entry)
-            if os.path.isdir(full_path):
+            if entry.is_dir():
                 tree.append({
-                    'text': entry,
+                    'text': entry.name,
                     'icon': 'jstree-folder',  # Folder icon
-                    'children': get_file_tree(full_path),
-                    'full_path': full_path
+                    'children': get_file_tree(entry.path),
+                    'full_path': entry.path
                 })
             else:
                 tree.append({
-                    'text': entry,
+                    'text': entry.name,
                     'icon': 'jstree-file',  # File icon
-                    'full_path': full_path
+                    'full_path': entry.path
                 })
     return tree
 
+@lru_cache(maxsize=256)
+def _get_file_tree_for_mtime(path, mtime_ns):
+    return get_file_tree(path)
+
+def get_cached_file_tree(path):
+    """
+    Same as get_file_tree, but reuses the last result while the modification time of 
+    path is unchanged. Only the top folder's time is checked, so use this for folders 
+    that aren't changing anymore, like completed processes. Don't modify the result.
+    """
+    if not os.path.isdir(path):
+        return []
+    return _get_file_tree_for_mtime(path, os.stat(path).st_mtime_ns)
+
 def get_project_reports_path():
     """
     Make this more flexible to handle a few variations. Warn if using the old convention
@@ -186,7 +230,7 @@ def get_project_reports_path():
         alt_path = os.path.join(get_data_folder(), 'Project_Reports')
         if os.path.isdir(alt_path):
             project_reports_path = alt_path
-            print('Note: Using <Project_Reports>. Please rename to <project-reports>')
+            current_app.logger.info('Note: Using <Project_Reports>. Please rename to <project-reports>')
     return project_reports_path
 
 def get_subject_reports_path(subject_name):
@@ -199,7 +243,7 @@ def get_subject_reports_path(subject_name):
         alt_path = os.path.join(get_subject_path(subject_name), 'Subject_Reports')
         if os.path.isdir(alt_path):
             subject_reports_path = alt_path
-            print(f'Note: Using <Subject_Reports> for {subject_name}. Please rename to <subject-reports>')
+            current_app.logger.info(f'Note: Using <Subject_Reports> for {subject_name}. Please rename to <subject-reports>')
     return subject_reports_path
 
 def get_series_number_from_folder(folder_name):
@@ -209,7 +253,7 @@ def get_series_number_from_folder(folder_name):
     :param folder_name: The name of the folder.
     :return: The series number as an integer, or None if the folder name does not match. 
     """
-    match = re.match(r'MR-SE(\d{3,5})-', folder_name)  # Match 3 to 5 digits
+    match = SERIES_FOLDER_PATTERN.match(folder_name)
     if match:
         return int(match.group(1))
     return None